@@ -1,12 +1,26 @@
 import numpy as np
+import atexit
+import hashlib
+import itertools
 import json
 import os
+import sqlite3
+import threading
 from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator, Optional, Sized, Tuple, Union
 from dataclasses import dataclass
 import chromadb
+import torch
 from sentence_transformers import SentenceTransformer
+from tqdm.auto import tqdm
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 @dataclass
@@ -18,6 +32,25 @@ class CodeChunk:
     metadata: Dict
 
 
+class _SafeFilenameTable(dict):
+    """str.translate table mapping every non-alphanumeric character to "_"."""
+    
+    def __missing__(self, codepoint: int):
+        value = codepoint if chr(codepoint).isalnum() else "_"
+        self[codepoint] = value
+        return value
+
+
+_SAFE_FILENAME_TABLE = _SafeFilenameTable()
+
+
+def _json_line(obj: Dict) -> bytes:
+    """Serialize obj as one compact JSON line, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
 class ChromaDBManagerWithEmbeddingSaver:
     """
     Enhanced ChromaDB manager that saves embeddings to disk.
@@ -26,17 +59,42 @@ class ChromaDBManagerWithEmbeddingSaver:
     - Generates embeddings explicitly
     - Saves embeddings + text to disk
     - Separate directories for document embeddings and query embeddings
-    - JSON format for easy inspection
+    - Compact .npy shards with a JSON Lines sidecar for inspection
     - Caching support
     """
     
+    # Corpora larger than this are spread across all visible GPUs
+    MULTI_PROCESS_THRESHOLD = 1000
+    
+    # Number of ChromaDB add() batches in flight at once
+    INSERT_WORKERS = 4
+    
+    # Chunks held in memory at once while streaming through add_chunks;
+    # kept above MULTI_PROCESS_THRESHOLD so multi-GPU encoding still applies
+    STREAM_WINDOW = 2048
+    
+    # Shard saves queued for the background writer before the encoder waits
+    MAX_PENDING_SAVES = 4
+    
+    # On-disk embedding formats
+    SHARD_SUFFIX = ".npy"
+    RECORDS_SUFFIX = ".jsonl"
+    LEGACY_SUFFIX = ".json"
+    STORAGE_DTYPES = ("float32", "float16", "int8")
+    
     def __init__(
         self,
         collection_name: str = "java_code",
         persist_directory: str = "./chroma_db",
         embedding_directory: str = "./embeddings",
         model_name: str = "all-MiniLM-L6-v2",
-        save_embeddings: bool = True
+        save_embeddings: bool = True,
+        device: Optional[str] = None,
+        storage_dtype: str = "float32",
+        backend: str = "torch",
+        onnx_file_name: Optional[str] = None,
+        cache_size: int = 100_000,
+        verbose: bool = False
     ):
         """
         Initialize ChromaDB manager with embedding saving.
@@ -47,8 +105,27 @@ class ChromaDBManagerWithEmbeddingSaver:
             embedding_directory: Directory to save embeddings and text
             model_name: Sentence transformer model name
             save_embeddings: Whether to save embeddings to disk
+            device: Device to run the model on ("cuda", "mps", "cpu").
+                Auto-detected when not given.
+            storage_dtype: Precision of saved shards: "float32", "float16"
+                (half the size) or "int8" (a quarter, scaled per shard)
+            backend: Inference backend for the model: "torch", "onnx" or
+                "openvino" (the latter two need sentence-transformers >= 3.2)
+            onnx_file_name: ONNX file to load with the "onnx" backend, e.g.
+                "onnx/model_qint8_avx512_vnni.onnx" for an int8 model
+            cache_size: Maximum number of embeddings kept in the in-memory
+                LRU cache (0 disables caching)
+            verbose: Print per-chunk and per-result details from add_chunks
+                and search (otherwise only a progress bar and totals)
         """
+        if storage_dtype not in self.STORAGE_DTYPES:
+            raise ValueError(
+                f"storage_dtype must be one of {self.STORAGE_DTYPES}, got {storage_dtype!r}"
+            )
+        
         self.save_embeddings = save_embeddings
+        self.verbose = verbose
+        self.storage_dtype = storage_dtype
         
         # Setup embedding directories
         self.embedding_dir = Path(embedding_directory)
@@ -64,19 +141,47 @@ class ChromaDBManagerWithEmbeddingSaver:
         
         # Load embedding model
         print(f"\n🔧 Loading embedding model '{model_name}'...")
-        self.embedding_model = SentenceTransformer(model_name)
+        self.device = device or self._detect_device()
+        self.backend = backend
+        if backend == "torch":
+            self.embedding_model = SentenceTransformer(model_name, device=self.device)
+            if self.device.startswith("cuda"):
+                # FP16 halves activation memory and enables tensor-core matmuls
+                self.embedding_model.half()
+            elif self.device == "cpu":
+                torch.set_num_threads(os.cpu_count() or 1)
+        else:
+            self.embedding_model = SentenceTransformer(
+                model_name,
+                device=self.device,
+                backend=backend,
+                model_kwargs=self._backend_model_kwargs(backend, onnx_file_name)
+            )
+        
+        # Cached so the save path doesn't query the model on every call
+        self._model_name = model_name
+        self._emb_dim = self.embedding_model.get_sentence_embedding_dimension()
+        
         print(f"  ✓ Model loaded")
-        print(f"  • Dimensions: {self.embedding_model.get_sentence_embedding_dimension()}")
+        print(f"  • Device: {self.device}")
+        print(f"  • Backend: {self.backend}")
+        print(f"  • Dimensions: {self._emb_dim}")
         print(f"  • Max sequence length: {self.embedding_model.max_seq_length}")
 
         # Create ChromaDB client
         print(f"\n💾 Initializing ChromaDB...")
         self.client = chromadb.PersistentClient(path=persist_directory)
+        self._sqlite_tuned = threading.local()
+        self._tune_sqlite()
         
         # Create or get collection
         self.collection = self.client.get_or_create_collection(
             name=collection_name,
-            metadata={"description": "Java code chunks with semantic embeddings"}
+            metadata={
+                "description": "Java code chunks with semantic embeddings",
+                # Embeddings are unit-length, so inner product equals cosine
+                "hnsw:space": "ip"
+            }
         )
         
         print(f"  ✓ ChromaDB initialized")
@@ -88,8 +193,93 @@ class ChromaDBManagerWithEmbeddingSaver:
         self.stats = {
             "documents_embedded": 0,
             "queries_embedded": 0,
-            "total_embeddings_generated": 0
+            "total_embeddings_generated": 0,
+            "cache_hits": 0
         }
+        
+        # LRU cache of embeddings keyed by a hash of the text
+        self.cache_size = cache_size
+        self._embedding_cache = OrderedDict()
+        
+        # Multi-GPU encode pool, started lazily and reused across calls
+        self._pool = None
+        
+        # Background writer so disk saves stay off the encode path
+        self._save_pool = ThreadPoolExecutor(max_workers=2)
+        self._save_futures = []
+        atexit.register(self._save_pool.shutdown, wait=True)
+        
+        # Shard names are unique within a session via a counter (even across
+        # threads); the microsecond timestamp and pid keep sessions apart
+        self._session_ts = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}"
+        self._save_counter = itertools.count()
+        
+        # Running counts of saved embeddings, updated by the writer threads
+        self._stats_lock = threading.Lock()
+        self.refresh_stats()
+    
+    def _tune_sqlite(self):
+        """
+        Move ChromaDB's SQLite store out of fsync-per-commit mode.
+        
+        journal_mode = WAL persists in the database file, so it is set once
+        here. synchronous is per connection and ChromaDB keeps one
+        connection per thread, so _tune_sqlite_connection also runs in each
+        insert worker. Relies on the Python SQLite backend of ChromaDB
+        0.4/0.5; on versions without it (e.g. the Rust bindings in
+        ChromaDB >= 1.0) tuning is skipped quietly.
+        """
+        try:
+            self._sqlite_pool = self.client._server._sysdb._conn_pool
+        except AttributeError:
+            self._sqlite_pool = None
+            return
+        
+        try:
+            self._sqlite_pool.connect().execute("pragma journal_mode = WAL")
+        except sqlite3.Error as e:
+            self._sqlite_pool = None
+            print(f"  ⚠️  SQLite tuning skipped: {e}")
+            return
+        
+        self._tune_sqlite_connection()
+    
+    def _tune_sqlite_connection(self):
+        """Apply per-connection SQLite pragmas to the calling thread's connection."""
+        if self._sqlite_pool is None or getattr(self._sqlite_tuned, "done", False):
+            return
+        
+        try:
+            self._sqlite_pool.connect().execute("pragma synchronous = NORMAL")
+        except sqlite3.Error as e:
+            print(f"  ⚠️  SQLite synchronous pragma skipped: {e}")
+        self._sqlite_tuned.done = True
+    
+    def _add_batch(self, **batch):
+        """Add one batch to the collection from an insert worker thread."""
+        self._tune_sqlite_connection()
+        self.collection.add(**batch)
+    
+    def _backend_model_kwargs(self, backend: str, onnx_file_name: Optional[str]) -> Dict:
+        """Build model_kwargs for the ONNX/OpenVINO SentenceTransformer backends."""
+        model_kwargs = {}
+        if backend == "onnx":
+            model_kwargs["provider"] = (
+                "CUDAExecutionProvider" if self.device.startswith("cuda")
+                else "CPUExecutionProvider"
+            )
+            if onnx_file_name:
+                model_kwargs["file_name"] = onnx_file_name
+        return model_kwargs
+    
+    @staticmethod
+    def _detect_device() -> str:
+        """Pick the fastest available device for the embedding model."""
+        if torch.cuda.is_available():
+            return "cuda"
+        if getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+            return "mps"
+        return "cpu"
     
     def generate_embedding(self, text: str, is_query: bool = False) -> np.ndarray:
         """
@@ -102,30 +292,196 @@ class ChromaDBManagerWithEmbeddingSaver:
         Returns:
             numpy array of embedding
         """
-        # Generate embedding
-        embedding = self.embedding_model.encode(text, show_progress_bar=False)
+        embeddings, _ = self._generate_embeddings_batch([text], is_query=is_query)
+        return embeddings[0]
+    
+    def _generate_embeddings_batch(
+        self,
+        texts: List[str],
+        is_query: bool = False,
+        batch_size: int = 64
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Generate embeddings for many texts in a single encode call.
+        
+        Texts already in the embedding cache, or repeated earlier in the
+        same batch, are not re-encoded. The rest are encoded shortest-first
+        so each batch is padded only to the length of its own longest text,
+        then restored to input order. Callers should pass texts in their
+        natural order, not pre-sorted.
+        
+        Args:
+            texts: Texts to embed
+            is_query: Whether these are queries (vs documents)
+            batch_size: Number of texts per forward pass of the model
+            
+        Returns:
+            Tuple of (embeddings of shape (len(texts), dimensions),
+            L2 norms of shape (len(texts),))
+        """
+        keys = [self._cache_key(t) for t in texts]
+        embeddings = np.empty(
+            (len(texts), self._emb_dim),
+            dtype=np.float32
+        )
+        
+        # Fill cache hits, grouping the rest by key so repeated texts
+        # within the batch are encoded only once
+        missing = {}
+        for i, key in enumerate(keys):
+            cached = self._embedding_cache.get(key)
+            if cached is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                embeddings[i] = cached
+                self._embedding_cache.move_to_end(key)
+        self.stats["cache_hits"] += len(texts) - len(missing)
+        
+        if missing:
+            missing_keys = list(missing)
+            missing_texts = [texts[missing[key][0]] for key in missing_keys]
+            
+            # Sort by length to minimise padding, then undo the permutation
+            order = np.argsort([len(t) for t in missing_texts], kind="stable")
+            sorted_embeddings = self._encode([missing_texts[i] for i in order], batch_size)
+            unique_embeddings = sorted_embeddings[np.argsort(order)]
+            
+            for key, embedding in zip(missing_keys, unique_embeddings):
+                embeddings[missing[key]] = embedding
+                self._cache_put(key, embedding.copy())
+        
+        norms = np.linalg.norm(embeddings, axis=1)
         
         # Update statistics
-        self.stats["total_embeddings_generated"] += 1
+        self.stats["total_embeddings_generated"] += len(texts)
         if is_query:
-            self.stats["queries_embedded"] += 1
+            self.stats["queries_embedded"] += len(texts)
         else:
-            self.stats["documents_embedded"] += 1
+            self.stats["documents_embedded"] += len(texts)
         
         # Save to disk if enabled
         if self.save_embeddings:
-            self._save_embedding_to_disk(text, embedding, is_query)
+            # Copy so the writer never sees buffers the encoder reuses
+            self._save_futures.append(self._save_pool.submit(
+                self._save_embeddings_to_disk, list(texts), embeddings.copy(), norms, is_query
+            ))
+            
+            # Backpressure: if the writer falls behind, wait for the oldest
+            # save so queued windows can't pile up in memory
+            while len(self._save_futures) > self.MAX_PENDING_SAVES:
+                self._save_futures.pop(0).result()
+        
+        return embeddings, norms
+    
+    @staticmethod
+    def _cache_key(text: str) -> str:
+        """Hash text into a compact embedding-cache key."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+    
+    def _cache_put(self, key: str, embedding: np.ndarray):
+        """Insert into the embedding cache, evicting the least recently used."""
+        if self.cache_size <= 0:
+            return
+        self._embedding_cache[key] = embedding
+        self._embedding_cache.move_to_end(key)
+        while len(self._embedding_cache) > self.cache_size:
+            self._embedding_cache.popitem(last=False)
+    
+    def load_cache_from_disk(self) -> int:
+        """
+        Warm the embedding cache from float32 shards saved by this model.
+        
+        Quantized shards are skipped so cached embeddings stay exact.
+        
+        Returns:
+            Number of embeddings added to the cache
+        """
+        count = 0
         
-        return embedding
+        self.flush()
+        for directory in (self.documents_dir, self.queries_dir):
+            for shard in directory.glob(f"*{self.SHARD_SUFFIX}"):
+                if self._shard_rows(shard) is None:
+                    continue
+                embeddings = np.load(shard, mmap_mode='r')
+                if embeddings.dtype != np.float32:
+                    continue
+                
+                with open(shard.with_suffix(self.RECORDS_SUFFIX), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        record = json.loads(line)
+                        if record['metadata'].get('model') != self._model_name:
+                            continue
+                        self._cache_put(
+                            self._cache_key(record['text']),
+                            np.array(embeddings[record['row_index']])
+                        )
+                        count += 1
+        
+        return count
+    
+    def flush(self):
+        """Wait for all pending background saves to finish writing to disk."""
+        futures, self._save_futures = self._save_futures, []
+        for future in futures:
+            # Re-raise any error from the writer thread
+            future.result()
+    
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        """
+        Run the embedding model over texts.
+        
+        Large inputs on multi-GPU machines go through a multi-process pool
+        (one worker per GPU); everything else uses a single encode call.
+        Embeddings are normalized to unit length so cosine similarity is a
+        plain dot product. The result is always float32, ready to hand to
+        ChromaDB without converting to Python lists.
+        """
+        if len(texts) > self.MULTI_PROCESS_THRESHOLD and torch.cuda.device_count() > 1:
+            if self._pool is None:
+                self._pool = self.embedding_model.start_multi_process_pool()
+            embeddings = self.embedding_model.encode_multi_process(
+                texts,
+                self._pool,
+                batch_size=batch_size,
+                normalize_embeddings=True
+            )
+        
+        else:
+            embeddings = self.embedding_model.encode(
+                texts,
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+        
+        # FP16 models on CUDA return float16; Chroma and the shards use float32
+        return embeddings.astype(np.float32, copy=False)
     
-    def _save_embedding_to_disk(self, text: str, embedding: np.ndarray, is_query: bool):
+    def _save_embeddings_to_disk(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        norms: np.ndarray,
+        is_query: bool
+    ) -> Path:
         """
-        Save embedding and associated text to disk.
+        Save a batch of embeddings and associated texts to disk as one shard.
+        
+        A shard is a pair of files sharing a base name:
+        - <name>.npy: array of shape (len(texts), dimensions) stored as
+          storage_dtype
+        - <name>.jsonl: one record per row of the array
+        
+        int8 shards are affine-quantized with a single per-shard scale,
+        recorded on every row so it can be dequantized on load.
         
-        File format:
+        Record format:
         {
             "text": "original text",
-            "embedding": [0.123, -0.456, ...],
+            "row_index": 0,
+            "scale": 0.0012,  (int8 shards only)
             "metadata": {
                 "timestamp": "2024-01-31T10:30:00",
                 "type": "query" or "document",
@@ -134,123 +490,216 @@ class ChromaDBManagerWithEmbeddingSaver:
                 "model": "all-MiniLM-L6-v2"
             }
         }
+        
+        Returns:
+            Path to the .npy shard
         """
         # Choose directory
         save_dir = self.queries_dir if is_query else self.documents_dir
         
-        # Generate filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        # Generate filename from the session timestamp and save counter
+        idx = next(self._save_counter)
+        saved_at = datetime.now().isoformat()
         prefix = "query" if is_query else "doc"
         
-        # Create safe filename from text
-        safe_text = "".join(c if c.isalnum() else "_" for c in text[:50])
-        filename = f"{prefix}_{timestamp}_{safe_text}.json"
-        filepath = save_dir / filename
+        # Create safe filename from the first text in the shard
+        safe_text = texts[0][:50].translate(_SAFE_FILENAME_TABLE)
+        shard_path = save_dir / f"{prefix}_{self._session_ts}_{idx:08d}_{safe_text}{self.SHARD_SUFFIX}"
+        records_path = shard_path.with_suffix(self.RECORDS_SUFFIX)
         
-        # Prepare data
-        data = {
-            "text": text,
-            "embedding": embedding.tolist(),
-            "metadata": {
-                "timestamp": datetime.now().isoformat(),
-                "type": "query" if is_query else "document",
-                "dimensions": len(embedding),
-                "norm": float(np.linalg.norm(embedding)),
-                "model": self.embedding_model._model_card_vars.get("model_name", "unknown"),
-                "text_length": len(text),
-                "word_count": len(text.split())
+        # Save embeddings as a single binary array
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        scale = None
+        if self.storage_dtype == "int8":
+            scale = float(np.max(np.abs(embeddings))) / 127 or 1.0
+            stored = np.round(embeddings / scale).astype(np.int8)
+        else:
+            stored = embeddings.astype(self.storage_dtype, copy=False)
+        # 'xb' so a name clash fails loudly instead of pairing mismatched files
+        with open(shard_path, 'xb') as f:
+            np.save(f, stored)
+            shard_bytes = os.fstat(f.fileno()).st_size
+        
+        # Save texts and metadata alongside, one line per row
+        lines = []
+        for row, (text, norm) in enumerate(zip(texts, norms)):
+            record = {
+                "text": text,
+                "row_index": row,
+                "metadata": {
+                    "timestamp": saved_at,
+                    "type": "query" if is_query else "document",
+                    "dimensions": self._emb_dim,
+                    "norm": float(norm),
+                    "model": self._model_name,
+                    "text_length": len(text),
+                    "word_count": len(text.split())
+                }
             }
-        }
+            if scale is not None:
+                record["scale"] = scale
+            lines.append(_json_line(record))
         
-        # Save to file
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        with open(records_path, 'xb') as f:
+            f.write(b"".join(lines))
+            records_bytes = os.fstat(f.fileno()).st_size
         
-        return filepath
+        with self._stats_lock:
+            if is_query:
+                self._query_embedding_count += len(texts)
+            else:
+                self._doc_embedding_count += len(texts)
+            self._total_bytes += shard_bytes + records_bytes
+        
+        return shard_path
     
-    def add_chunks(self, chunks: List[CodeChunk], batch_size: int = 100):
+    @staticmethod
+    def _suggest_batch_size(n_chunks: Optional[int], dim: int) -> int:
+        """
+        Suggest a ChromaDB insert batch size for n_chunks of the given dimension.
+        
+        Targets roughly 4 MB of float32 embeddings per batch, clamped to
+        64-250, inside the 50-250 range where ChromaDB inserts are most
+        efficient. n_chunks may be None when the number of chunks isn't
+        known up front.
+        """
+        suggested = min(250, max(64, 4_000_000 // (dim * 4)))
+        if n_chunks is None:
+            return suggested
+        return max(1, min(suggested, n_chunks))
+    
+    def add_chunks(self, chunks: Iterable[CodeChunk], batch_size: Optional[int] = None):
         """
         Add code chunks to ChromaDB with explicit embedding generation.
         
-        Process:
+        Chunks are streamed in windows of STREAM_WINDOW, so any iterable
+        (including a generator) can be passed and peak memory stays
+        bounded regardless of corpus size.
+        
+        Process, per window:
         1. Extract text content from chunks
-        2. Generate embeddings explicitly (and save to disk)
+        2. Generate embeddings explicitly in one batched call (and save to disk)
         3. Prepare metadata
         4. Add to ChromaDB with pre-computed embeddings
+        
+        Args:
+            chunks: Code chunks to add
+            batch_size: Chunks per ChromaDB insert. Chosen from the embedding
+                dimension when not given.
         """
-        if not chunks:
+        total = len(chunks) if isinstance(chunks, Sized) else None
+        if total == 0:
             print("No chunks to add")
             return
         
-        print(f"\n{'='*70}")
-        print(f"🔄 PROCESSING {len(chunks)} CHUNKS")
-        print(f"{'='*70}\n")
+        if batch_size is None:
+            batch_size = self._suggest_batch_size(total, self._emb_dim)
+        elif batch_size < 50:
+            print(f"⚠️  batch_size={batch_size} is small; ChromaDB inserts are "
+                  f"most efficient with batches of 50-250")
+        window_size = max(batch_size, self.STREAM_WINDOW)
         
-        documents = []
-        embeddings = []
-        metadatas = []
-        ids = []
-        
-        for i, chunk in enumerate(chunks, 1):
-            # Extract content
-            content = chunk.content
-            documents.append(content)
-            
-            # Generate embedding explicitly
-            print(f"Chunk {i}/{len(chunks)}:")
-            print(f"  Type: {chunk.chunk_type}")
-            print(f"  Text length: {len(content)} chars")
-            print(f"  Generating embedding...")
-            
-            embedding = self.generate_embedding(content, is_query=False)
-            embeddings.append(embedding.tolist())
-            
-            print(f"  ✓ Embedding: {len(embedding)} dimensions")
-            print(f"    First 5 values: [{embedding[0]:.4f}, {embedding[1]:.4f}, {embedding[2]:.4f}, ...]")
-            print(f"    Norm: {np.linalg.norm(embedding):.4f}")
-            
-            if self.save_embeddings:
-                print(f"    💾 Saved to: {self.documents_dir}")
-            print()
-            
-            # Prepare metadata
-            metadata = {
-                'chunk_type': chunk.chunk_type,
-                'start_line': str(chunk.start_line),
-                'end_line': str(chunk.end_line),
-                'file_path': chunk.metadata.get('file_path', ''),
-                'class_name': chunk.metadata.get('class_name', ''),
-                'method_name': chunk.metadata.get('method_name', '')
-            }
-            metadatas.append(metadata)
-            
-            # Generate unique ID
-            chunk_id = f"{chunk.metadata.get('file_path', 'unknown')}_{chunk.chunk_type}_{i}"
-            ids.append(chunk_id)
+        if self.verbose:
+            print(f"\n{'='*70}")
+            print(f"🔄 PROCESSING {total if total is not None else 'STREAMED'} CHUNKS")
+            print(f"{'='*70}\n")
         
-        # Add to ChromaDB in batches
-        print(f"{'─'*70}")
-        print(f"💾 Storing in ChromaDB...")
+        chunk_iter = iter(chunks)
+        added = 0
+        batch_num = 0
+        pending = deque()
         
-        for i in range(0, len(documents), batch_size):
-            batch_docs = documents[i:i+batch_size]
-            batch_embeds = embeddings[i:i+batch_size]
-            batch_metas = metadatas[i:i+batch_size]
-            batch_ids = ids[i:i+batch_size]
+        # Inserts run concurrently with encoding of the next window; at most
+        # INSERT_WORKERS batches are in flight so memory stays bounded
+        with ThreadPoolExecutor(max_workers=self.INSERT_WORKERS) as executor, \
+                tqdm(total=total, unit="chunk", desc="Adding chunks") as progress:
+            while True:
+                window = list(itertools.islice(chunk_iter, window_size))
+                if not window:
+                    break
+                
+                documents = [chunk.content for chunk in window]
+                embeddings, norms = self._generate_embeddings_batch(documents, is_query=False)
+                
+                metadatas = []
+                ids = []
+                
+                for i, (chunk, embedding, norm) in enumerate(zip(window, embeddings, norms), added + 1):
+                    if self.verbose:
+                        self._print_chunk(i, total, chunk, embedding, norm)
+                    
+                    # Prepare metadata
+                    metadata = {
+                        'chunk_type': chunk.chunk_type,
+                        'start_line': str(chunk.start_line),
+                        'end_line': str(chunk.end_line),
+                        'file_path': chunk.metadata.get('file_path', ''),
+                        'class_name': chunk.metadata.get('class_name', ''),
+                        'method_name': chunk.metadata.get('method_name', '')
+                    }
+                    metadatas.append(metadata)
+                    
+                    # Generate unique ID
+                    chunk_id = f"{chunk.metadata.get('file_path', 'unknown')}_{chunk.chunk_type}_{i}"
+                    ids.append(chunk_id)
+                
+                # Add to ChromaDB in batches
+                for start in range(0, len(documents), batch_size):
+                    if len(pending) >= self.INSERT_WORKERS:
+                        self._finish_insert(*pending.popleft())
+                    
+                    batch_num += 1
+                    batch_ids = ids[start:start+batch_size]
+                    future = executor.submit(
+                        self._add_batch,
+                        documents=documents[start:start+batch_size],
+                        embeddings=embeddings[start:start+batch_size],
+                        metadatas=metadatas[start:start+batch_size],
+                        ids=batch_ids
+                    )
+                    pending.append((batch_num, future, len(batch_ids)))
+                
+                added += len(window)
+                progress.update(len(window))
             
-            self.collection.add(
-                documents=batch_docs,
-                embeddings=batch_embeds,
-                metadatas=batch_metas,
-                ids=batch_ids
-            )
-            
-            print(f"  Batch {i//batch_size + 1}: Added {len(batch_docs)} chunks")
+            while pending:
+                self._finish_insert(*pending.popleft())
+        
+        if added == 0:
+            print("No chunks to add")
+            return
         
-        print(f"\n✓ Successfully added {len(chunks)} chunks to ChromaDB")
+        print(f"\n✓ Successfully added {added} chunks to ChromaDB")
         print(f"  Total chunks in collection: {self.collection.count()}")
+        self.flush()
         self._print_statistics()
     
+    def _print_chunk(
+        self,
+        i: int,
+        total: Optional[int],
+        chunk: CodeChunk,
+        embedding: np.ndarray,
+        norm: float
+    ):
+        """Print details for one embedded chunk without breaking the progress bar."""
+        tqdm.write(f"Chunk {i}/{total if total is not None else '?'}:")
+        tqdm.write(f"  Type: {chunk.chunk_type}")
+        tqdm.write(f"  Text length: {len(chunk.content)} chars")
+        tqdm.write(f"  ✓ Embedding: {self._emb_dim} dimensions")
+        tqdm.write(f"    First 5 values: [{embedding[0]:.4f}, {embedding[1]:.4f}, {embedding[2]:.4f}, ...]")
+        tqdm.write(f"    Norm: {norm:.4f}")
+        
+        if self.save_embeddings:
+            tqdm.write(f"    💾 Saved to: {self.documents_dir}")
+        tqdm.write("")
+    
+    def _finish_insert(self, batch_num: int, future, batch_len: int):
+        """Wait for one submitted ChromaDB insert and report it."""
+        future.result()
+        if self.verbose:
+            tqdm.write(f"  Batch {batch_num}: Added {batch_len} chunks")
+    
     def search(self, query: str, n_results: int = 5) -> Dict:
         """
         Search for similar code chunks using semantic similarity.
@@ -263,59 +712,83 @@ class ChromaDBManagerWithEmbeddingSaver:
         Returns:
             Dictionary with documents, metadatas, and distances
         """
-        print(f"\n{'='*70}")
-        print(f"🔍 SEARCH QUERY")
-        print(f"{'='*70}")
-        print(f"Query: '{query}'")
-        print(f"Query length: {len(query)} chars\n")
+        if self.verbose:
+            print(f"\n{'='*70}")
+            print(f"🔍 SEARCH QUERY")
+            print(f"{'='*70}")
+            print(f"Query: '{query}'")
+            print(f"Query length: {len(query)} chars\n")
         
         # Generate query embedding
-        print(f"Generating query embedding...")
-        query_embedding = self.generate_embedding(query, is_query=True)
+        query_embeddings, query_norms = self._generate_embeddings_batch([query], is_query=True)
+        query_embedding = query_embeddings[0]
         
-        print(f"✓ Query embedding: {len(query_embedding)} dimensions")
-        print(f"  First 5 values: [{query_embedding[0]:.4f}, {query_embedding[1]:.4f}, {query_embedding[2]:.4f}, ...]")
-        print(f"  Norm: {np.linalg.norm(query_embedding):.4f}")
-        
-        if self.save_embeddings:
-            print(f"  💾 Saved to: {self.queries_dir}")
+        if self.verbose:
+            print(f"✓ Query embedding: {self._emb_dim} dimensions")
+            print(f"  First 5 values: [{query_embedding[0]:.4f}, {query_embedding[1]:.4f}, {query_embedding[2]:.4f}, ...]")
+            print(f"  Norm: {query_norms[0]:.4f}")
+            
+            if self.save_embeddings:
+                print(f"  💾 Saved to: {self.queries_dir}")
         
         # Search ChromaDB
-        print(f"\nSearching ChromaDB...")
         results = self.collection.query(
-            query_embeddings=[query_embedding.tolist()],
+            query_embeddings=query_embedding[np.newaxis, :],
             n_results=n_results
         )
         
         # Display results
-        print(f"\n{'─'*70}")
-        print(f"📊 SEARCH RESULTS (Top {n_results})")
-        print(f"{'─'*70}\n")
-        
-        for i, (doc, meta, distance) in enumerate(zip(
-            results['documents'][0],
-            results['metadatas'][0],
-            results['distances'][0]
-        ), 1):
-            similarity = 1 - distance
-            print(f"Result #{i}:")
-            print(f"  Similarity: {similarity:.4f} ({similarity*100:.2f}%)")
-            print(f"  Type: {meta.get('chunk_type', 'unknown')}")
-            print(f"  Class: {meta.get('class_name', 'N/A')}")
-            print(f"  Method: {meta.get('method_name', 'N/A')}")
-            print(f"  Preview: {doc[:80]}...")
-            print()
+        if self.verbose:
+            print(f"\n{'─'*70}")
+            print(f"📊 SEARCH RESULTS (Top {n_results})")
+            print(f"{'─'*70}\n")
+            
+            for i, (doc, meta, distance) in enumerate(zip(
+                results['documents'][0],
+                results['metadatas'][0],
+                results['distances'][0]
+            ), 1):
+                similarity = 1 - distance
+                print(f"Result #{i}:")
+                print(f"  Similarity: {similarity:.4f} ({similarity*100:.2f}%)")
+                print(f"  Type: {meta.get('chunk_type', 'unknown')}")
+                print(f"  Class: {meta.get('class_name', 'N/A')}")
+                print(f"  Method: {meta.get('method_name', 'N/A')}")
+                print(f"  Preview: {doc[:80]}...")
+                print()
+            
+            self._print_statistics()
         
-        self._print_statistics()
         return results
     
-    def load_embedding_from_disk(self, filepath: str) -> Dict:
+    def load_embedding_from_disk(self, filepath: str, row: Optional[int] = None) -> Dict:
         """
         Load a saved embedding from disk.
         
+        Args:
+            filepath: Path to a .npy shard, or to a legacy per-embedding JSON file
+            row: Row within the shard (required for shards, ignored for JSON)
+        
         Returns:
             Dictionary with text, embedding, and metadata
         """
+        filepath = Path(filepath)
+        
+        if filepath.suffix == self.SHARD_SUFFIX:
+            if row is None:
+                raise ValueError(f"A row index is required to load from shard {filepath}")
+            
+            with open(filepath.with_suffix(self.RECORDS_SUFFIX), 'r', encoding='utf-8') as f:
+                data = json.loads(next(itertools.islice(f, row, None)))
+            
+            # Memory-map the shard so only the requested row is read, then
+            # dequantize back to float32
+            embedding = np.load(filepath, mmap_mode='r')[row].astype(np.float32)
+            if 'scale' in data:
+                embedding *= data['scale']
+            data['embedding'] = embedding
+            return data
+        
         with open(filepath, 'r', encoding='utf-8') as f:
             data = json.load(f)
         
@@ -323,7 +796,10 @@ class ChromaDBManagerWithEmbeddingSaver:
         data['embedding'] = np.array(data['embedding'])
         return data
     
-    def list_saved_embeddings(self, embedding_type: str = "all") -> List[Path]:
+    def list_saved_embeddings(
+        self,
+        embedding_type: str = "all"
+    ) -> List[Tuple[Path, Optional[int]]]:
         """
         List all saved embeddings.
         
@@ -331,33 +807,78 @@ class ChromaDBManagerWithEmbeddingSaver:
             embedding_type: "documents", "queries", or "all"
             
         Returns:
-            List of file paths
+            List of (shard path, row) tuples; legacy JSON files have row None
         """
+        self.flush()
         embeddings = []
         
         if embedding_type in ["documents", "all"]:
-            embeddings.extend(self.documents_dir.glob("*.json"))
+            embeddings.extend(self._list_embeddings_in(self.documents_dir))
         
         if embedding_type in ["queries", "all"]:
-            embeddings.extend(self.queries_dir.glob("*.json"))
+            embeddings.extend(self._list_embeddings_in(self.queries_dir))
         
         return sorted(embeddings)
     
-    def compare_saved_embeddings(self, filepath1: str, filepath2: str):
+    def _list_embeddings_in(self, directory: Path) -> List[Tuple[Path, Optional[int]]]:
+        """List (shard path, row) entries for every embedding saved in directory."""
+        entries = [(f, None) for f in directory.glob(f"*{self.LEGACY_SUFFIX}")]
+        
+        for shard in directory.glob(f"*{self.SHARD_SUFFIX}"):
+            n_rows = self._shard_rows(shard)
+            if n_rows is not None:
+                entries.extend((shard, row) for row in range(n_rows))
+        
+        return entries
+    
+    def _shard_rows(self, shard: Union[str, Path]) -> Optional[int]:
         """
-        Compare two saved embeddings.
+        Read a shard's row count from its .npy header without loading data.
+        
+        Returns None (with a warning) for shards whose header is unreadable
+        or whose data is shorter than the header promises, e.g. after a
+        process was killed mid-write.
+        """
+        try:
+            with open(shard, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+                data_start = f.tell()
+                data_size = os.fstat(f.fileno()).st_size - data_start
+        except (ValueError, OSError) as e:
+            print(f"⚠️  Skipping unreadable shard {shard}: {e}")
+            return None
+        
+        if len(shape) != 2 or data_size < int(np.prod(shape)) * dtype.itemsize:
+            print(f"⚠️  Skipping truncated shard {shard}")
+            return None
+        
+        return shape[0]
+    
+    def compare_saved_embeddings(
+        self,
+        entry1: Union[str, Tuple[Path, Optional[int]]],
+        entry2: Union[str, Tuple[Path, Optional[int]]]
+    ):
         """
-        from sklearn.metrics.pairwise import cosine_similarity
+        Compare two saved embeddings.
         
+        Args:
+            entry1, entry2: Entries from list_saved_embeddings, or plain
+                paths to legacy JSON files
+        """
         # Load embeddings
-        data1 = self.load_embedding_from_disk(filepath1)
-        data2 = self.load_embedding_from_disk(filepath2)
+        data1 = self._load_entry(entry1)
+        data2 = self._load_entry(entry2)
         
         emb1 = data1['embedding']
         emb2 = data2['embedding']
         
-        # Calculate similarity
-        similarity = cosine_similarity([emb1], [emb2])[0][0]
+        # Calculate similarity (divide by norms for legacy unnormalized files)
+        similarity = float(emb1 @ emb2) / float(np.linalg.norm(emb1) * np.linalg.norm(emb2))
         
         print(f"\n{'='*70}")
         print(f"🔬 EMBEDDING COMPARISON")
@@ -369,6 +890,12 @@ class ChromaDBManagerWithEmbeddingSaver:
         
         return similarity
     
+    def _load_entry(self, entry: Union[str, Tuple[Path, Optional[int]]]) -> Dict:
+        """Load either a (shard path, row) tuple or a plain legacy JSON path."""
+        if isinstance(entry, tuple):
+            return self.load_embedding_from_disk(*entry)
+        return self.load_embedding_from_disk(entry)
+    
     def get_all_chunks(self) -> Dict:
         """Retrieve all chunks from the collection."""
         return self.collection.get()
@@ -378,6 +905,19 @@ class ChromaDBManagerWithEmbeddingSaver:
         self.client.delete_collection(self.collection.name)
         print(f"✓ Deleted collection: {self.collection.name}")
     
+    def close(self):
+        """Finish pending saves and stop the multi-GPU encode pool if one was started."""
+        self.flush()
+        if self._pool is not None:
+            self.embedding_model.stop_multi_process_pool(self._pool)
+            self._pool = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
     def clear_saved_embeddings(self, embedding_type: str = "all"):
         """
         Clear saved embeddings from disk.
@@ -385,20 +925,69 @@ class ChromaDBManagerWithEmbeddingSaver:
         Args:
             embedding_type: "documents", "queries", or "all"
         """
-        count = 0
+        count = len(self.list_saved_embeddings(embedding_type))
         
         if embedding_type in ["documents", "all"]:
-            for f in self.documents_dir.glob("*.json"):
+            for f in self._embedding_files_in(self.documents_dir):
                 f.unlink()
-                count += 1
         
         if embedding_type in ["queries", "all"]:
-            for f in self.queries_dir.glob("*.json"):
+            for f in self._embedding_files_in(self.queries_dir):
                 f.unlink()
-                count += 1
         
+        self.refresh_stats()
         print(f"✓ Cleared {count} saved embeddings")
     
+    def _embedding_files_in(self, directory: Path) -> List[Path]:
+        """All shard, record and legacy JSON files in directory."""
+        suffixes = (self.SHARD_SUFFIX, self.RECORDS_SUFFIX, self.LEGACY_SUFFIX)
+        return [f for f in directory.glob("*") if f.suffix in suffixes]
+    
+    def refresh_stats(self):
+        """Recompute saved-embedding counts and disk usage from what is on disk."""
+        self.flush()
+        doc_count, doc_bytes = self._scan_embedding_files(str(self.documents_dir))
+        query_count, query_bytes = self._scan_embedding_files(str(self.queries_dir))
+        
+        with self._stats_lock:
+            self._doc_embedding_count = doc_count
+            self._query_embedding_count = query_count
+            self._total_bytes = doc_bytes + query_bytes
+    
+    def _scan_embedding_files(self, root: str) -> Tuple[int, int]:
+        """
+        Count saved embeddings under root and sum the size of their files.
+        
+        Each shard contributes its row count (read from the .npy header
+        only), each legacy JSON file one embedding. Uses os.scandir so
+        directory entries carry their own type and stat information,
+        instead of building a Path and stat-ing every file.
+        
+        Returns:
+            Tuple of (embedding count, total bytes)
+        """
+        suffixes = (self.SHARD_SUFFIX, self.RECORDS_SUFFIX, self.LEGACY_SUFFIX)
+        count = 0
+        total = 0
+        
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_count, sub_total = self._scan_embedding_files(entry.path)
+                        count += sub_count
+                        total += sub_total
+                    elif entry.name.endswith(suffixes):
+                        if entry.name.endswith(self.SHARD_SUFFIX):
+                            count += self._shard_rows(entry.path) or 0
+                        elif entry.name.endswith(self.LEGACY_SUFFIX):
+                            count += 1
+                        total += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        
+        return count, total
+    
     def _print_statistics(self):
         """Print embedding generation statistics."""
         print(f"\n{'─'*70}")
@@ -407,19 +996,42 @@ class ChromaDBManagerWithEmbeddingSaver:
         print(f"Total embeddings generated: {self.stats['total_embeddings_generated']}")
         print(f"  • Documents: {self.stats['documents_embedded']}")
         print(f"  • Queries: {self.stats['queries_embedded']}")
+        print(f"  • Cache hits: {self.stats['cache_hits']}")
         
         if self.save_embeddings:
-            doc_files = len(list(self.documents_dir.glob("*.json")))
-            query_files = len(list(self.queries_dir.glob("*.json")))
             print(f"\nSaved to disk:")
-            print(f"  • Document embeddings: {doc_files} files")
-            print(f"  • Query embeddings: {query_files} files")
-            
-            # Calculate disk usage
-            total_size = sum(f.stat().st_size for f in self.embedding_dir.rglob("*.json"))
-            print(f"  • Total disk usage: {total_size / 1024:.2f} KB")
+            print(f"  • Document embeddings: {self._doc_embedding_count}")
+            print(f"  • Query embeddings: {self._query_embedding_count}")
+            print(f"  • Total disk usage: {self._total_bytes / 1024:.2f} KB")
         print(f"{'─'*70}\n")
     
+    def _iter_saved_records(self, directory: Path) -> Iterator[Tuple[Path, Optional[int], Dict]]:
+        """
+        Yield (shard path, row, record) for every embedding saved in directory.
+        
+        Shard records are streamed from their .jsonl sidecar without
+        touching the .npy arrays. Legacy JSON files have no sidecar, so
+        they are parsed in full and their embedding dropped.
+        """
+        files = sorted(
+            list(directory.glob(f"*{self.RECORDS_SUFFIX}"))
+            + list(directory.glob(f"*{self.LEGACY_SUFFIX}"))
+        )
+        
+        for filepath in files:
+            if filepath.suffix == self.LEGACY_SUFFIX:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                data.pop('embedding', None)
+                yield filepath, None, data
+                continue
+            
+            shard_path = filepath.with_suffix(self.SHARD_SUFFIX)
+            with open(filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    yield shard_path, record['row_index'], record
+    
     def export_embeddings_summary(self, output_file: str = "embeddings_summary.json"):
         """
         Export a summary of all embeddings to a JSON file.
@@ -427,28 +1039,30 @@ class ChromaDBManagerWithEmbeddingSaver:
         summary = {
             "statistics": self.stats,
             "model_info": {
-                "name": self.embedding_model._model_card_vars.get("model_name", "unknown"),
-                "dimensions": self.embedding_model.get_sentence_embedding_dimension(),
+                "name": self._model_name,
+                "dimensions": self._emb_dim,
                 "max_seq_length": self.embedding_model.max_seq_length
             },
             "documents": [],
             "queries": []
         }
         
+        self.flush()
+        
         # Add document embeddings info
-        for filepath in self.list_saved_embeddings("documents"):
-            data = self.load_embedding_from_disk(str(filepath))
+        for filepath, row, data in self._iter_saved_records(self.documents_dir):
             summary["documents"].append({
                 "filename": filepath.name,
+                "row": row,
                 "text_preview": data['text'][:100],
                 "metadata": data['metadata']
             })
         
         # Add query embeddings info
-        for filepath in self.list_saved_embeddings("queries"):
-            data = self.load_embedding_from_disk(str(filepath))
+        for filepath, row, data in self._iter_saved_records(self.queries_dir):
             summary["queries"].append({
                 "filename": filepath.name,
+                "row": row,
                 "text": data['text'],
                 "metadata": data['metadata']
             })